@@ -4,11 +4,14 @@ Handles daily archiving and cleanup of motion detection data.
 """
 
 import logging
+import os
+import re
 import shutil
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 import json
 
 from config import config
@@ -16,6 +19,160 @@ from database import db
 
 logger = logging.getLogger(__name__)
 
+# Parallel archive_date jobs; leave half the cores to the capture and bot services
+ARCHIVE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Write buffer for the temporary tar file
+ARCHIVE_WRITE_BUFFER = 4 * 1024 * 1024
+
+# Chunk size for copying member data into the tar and tar data into gzip
+ARCHIVE_COPY_BUFFER = 1024 * 1024
+
+# posix_fadvise/posix_fallocate are Linux/POSIX only
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+HAS_FALLOCATE = hasattr(os, 'posix_fallocate')
+
+# Resolved once at import instead of exec'ing zstd per archive to find out it's missing
+ZSTD_PATH = shutil.which('zstd')
+
+# Upper bound for one zstd run so a wedged process can't stall the cleanup job
+ARCHIVE_TOOL_TIMEOUT = 600
+
+
+def _lower_thread_priority():
+    """Executor initializer: run maintenance at idle priority so capture keeps the CPU.
+    
+    On Linux nice and scheduling policy are per-thread, so only the worker is affected.
+    """
+    try:
+        os.nice(10)
+        if hasattr(os, 'sched_setscheduler'):
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except OSError as e:
+        logger.debug(f"Could not lower maintenance thread priority: {e}")
+
+
+# Date directory (YYYY-MM-DD) or its archive (YYYY-MM-DD.tar.zst / .tar.gz)
+_DATE_NAME_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})(\.tar(?:\.\w+)+)?')
+
+
+def _parse_date_name(name: str, archive: bool = False) -> Optional[datetime]:
+    """Date of a frames directory or archive file name, None for anything else"""
+    m = _DATE_NAME_RE.fullmatch(name)
+    if m is None or (m[4] is not None) != archive:
+        return None
+    try:
+        return datetime(int(m[1]), int(m[2]), int(m[3]))
+    except ValueError:
+        # Date-shaped but out of range, e.g. 2024-13-01
+        return None
+
+
+def _scandir_walk(path) -> Iterator[os.DirEntry]:
+    """Yield DirEntry objects for every regular file below path (iterative, no Path objects)"""
+    stack = [os.fspath(path)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except (FileNotFoundError, PermissionError) as e:
+            # Skip a directory that vanished or is unreadable rather than abort the walk
+            logger.warning(f"Skipping directory during scan: {e}")
+
+
+def _scan_dir_stats(path) -> Tuple[int, int]:
+    """Count files and total bytes below path in one traversal"""
+    count = 0
+    size = 0
+    for entry in _scandir_walk(path):
+        try:
+            size += entry.stat(follow_symlinks=False).st_size
+            count += 1
+        except FileNotFoundError:
+            continue
+    return count, size
+
+
+def _add_tar_member(tar: tarfile.TarFile, entry: os.DirEntry, arcname: str):
+    """Add a regular file to tar using the DirEntry's stat.
+    
+    tar.add() would lstat the file again and look up owner/group names for every member.
+    """
+    st = entry.stat(follow_symlinks=False)
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)  # A float mtime costs an extra pax header block per member
+    info.mode = st.st_mode & 0o7777
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    fd = os.open(entry.path, os.O_RDONLY)
+    with os.fdopen(fd, 'rb') as f:
+        if HAS_FADVISE:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        tar.addfile(info, f)
+        if HAS_FADVISE:
+            # Read once and never again; don't let it push live camera pages out of the cache
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _estimate_tar_size(entries: List[os.DirEntry]) -> int:
+    """Upper estimate of a ustar archive holding entries: header + padded data each"""
+    size = 2 * tarfile.BLOCKSIZE  # End-of-archive marker
+    for entry in entries:
+        data = entry.stat(follow_symlinks=False).st_size
+        size += tarfile.BLOCKSIZE + -(-data // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def _preallocate(f, size: int):
+    """Reserve size bytes for a file being written, where the platform supports it"""
+    if not HAS_FALLOCATE or size <= 0:
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        # Not supported by every filesystem; the write just proceeds unreserved
+        logger.debug(f"posix_fallocate failed: {e}")
+
+
+def _remove_archived_tree(root: Path, files: List[str]):
+    """Delete a directory tree using the file list gathered while archiving it.
+    
+    Saves rmtree walking the tree a second time; rmtree only runs as a fallback when
+    something not in the list (e.g. an empty subdirectory) is left behind.
+    """
+    root = os.fspath(root)
+    dirs = {root}
+    for path in files:
+        os.unlink(path)
+        # Record the file's directory and any intermediate ones up to root
+        parent = os.path.dirname(path)
+        while parent not in dirs and len(parent) > len(root):
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    
+    # Deepest first so each directory is empty by the time it is removed
+    try:
+        for path in sorted(dirs, key=len, reverse=True):
+            os.rmdir(path)
+    except OSError:
+        shutil.rmtree(root)
+
+
+def _flush_and_drop_cache(path: Path):
+    """fsync a finished archive and drop it from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if HAS_FADVISE:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
 
 class ArchiveManager:
     """Manages archiving and cleanup of turtle detection data"""
@@ -25,8 +182,71 @@ class ArchiveManager:
         self.archives_path = config.get_archives_path()
         self.archives_path.mkdir(parents=True, exist_ok=True)
     
-    def archive_date(self, date: datetime) -> bool:
-        """Archive all data for a specific date"""
+    @staticmethod
+    def _list_entries(path: Path, dirs: bool) -> List[str]:
+        """List names of subdirectories (or regular files) in path with a single scandir"""
+        try:
+            with os.scandir(path) as entries:
+                if dirs:
+                    return [e.name for e in entries if e.is_dir(follow_symlinks=False)]
+                return [e.name for e in entries if e.is_file(follow_symlinks=False)]
+        except FileNotFoundError:
+            return []
+    
+    def _add_entries(self, tar: tarfile.TarFile, entries: List[os.DirEntry]):
+        """Add files to tar with paths relative to the frames root"""
+        for entry in entries:
+            _add_tar_member(tar, entry, os.path.relpath(entry.path, self.frames_path))
+    
+    def _write_zstd_archive(self, entries: List[os.DirEntry], archive_path: Path, level: int,
+                            threads: int = 0) -> bool:
+        """Pipe a tar stream of entries through zstd (threads=0: one per core) into archive_path"""
+        import subprocess
+        with open(archive_path, 'wb') as out:
+            # Reserve the estimate up front so the filesystem can lay the file out
+            # contiguously; JPEGs barely compress, so the tar size is a close bound
+            _preallocate(out, _estimate_tar_size(entries))
+            proc = subprocess.Popen(
+                [ZSTD_PATH, '-q', f'-{level}', f'-T{threads}', '-c'],
+                stdin=subprocess.PIPE, stdout=out, stderr=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|', bufsize=ARCHIVE_COPY_BUFFER,
+                                  copybufsize=ARCHIVE_COPY_BUFFER) as tar:
+                    self._add_entries(tar, entries)
+                # communicate() closes stdin, which ends the zstd frame
+                _, stderr = proc.communicate(timeout=ARCHIVE_TOOL_TIMEOUT)
+            except BrokenPipeError:
+                _, stderr = proc.communicate(timeout=ARCHIVE_TOOL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                logger.warning(f"zstd timed out after {ARCHIVE_TOOL_TIMEOUT}s, falling back to gzip")
+                return False
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+            
+            if proc.returncode != 0:
+                logger.warning(f"zstd failed, falling back to gzip: {stderr.decode(errors='replace')}")
+                return False
+            
+            # zstd wrote through a shared file offset; trim what the estimate over-reserved
+            os.ftruncate(out.fileno(), os.lseek(out.fileno(), 0, os.SEEK_CUR))
+        return True
+    
+    def _write_gzip_archive(self, entries: List[os.DirEntry], archive_path: Path, level: int):
+        """Write entries as a gzip-compressed tar to archive_path"""
+        # Large output buffer: many small JPEG members would otherwise mean many small writes
+        with open(archive_path, 'wb', buffering=ARCHIVE_WRITE_BUFFER) as out:
+            _preallocate(out, _estimate_tar_size(entries))
+            with tarfile.open(fileobj=out, mode='w:gz', compresslevel=min(level, 9),
+                              copybufsize=ARCHIVE_COPY_BUFFER) as tar:
+                self._add_entries(tar, entries)
+            out.truncate()
+    
+    def archive_date(self, date: datetime, threads: int = 0) -> bool:
+        """Archive all data for a specific date using up to threads zstd workers (0: all cores)"""
         try:
             date_str = date.strftime("%Y-%m-%d")
             date_dir = self.frames_path / date_str
@@ -44,49 +264,31 @@ class ArchiveManager:
                 logger.info(f"Archive already exists: {archive_name}")
                 return True
             
-            # Create temporary tar file first
-            temp_tar_path = archive_path.with_suffix('.tar')
+            entries = list(_scandir_walk(date_dir))
+            level = config.storage.archive_compression_level
             
-            with tarfile.open(temp_tar_path, 'w') as tar:
-                # Add all files from the date directory
-                for file_path in date_dir.rglob('*'):
-                    if file_path.is_file():
-                        # Add with relative path
-                        arcname = file_path.relative_to(self.frames_path)
-                        tar.add(file_path, arcname=arcname)
-            
-            # Compress with zstd if available, otherwise use gzip
+            # Stream the tar straight into the compressor: the uncompressed tar is never
+            # written to the SD card and read back. Use zstd if available, otherwise gzip
+            # Written under a temporary name so a failed run never leaves a truncated
+            # archive that the exists() check above would later accept
+            partial_path = self.archives_path / f"{date_str}.part"
             try:
-                import subprocess
-                result = subprocess.run([
-                    'zstd', '-q', str(temp_tar_path), '-o', str(archive_path)
-                ], capture_output=True)
-                
-                if result.returncode == 0:
-                    temp_tar_path.unlink()  # Remove temporary tar file
-                    logger.info(f"Created zstd archive: {archive_name}")
-                else:
-                    # Fall back to gzip
-                    archive_path = archive_path.with_suffix('.tar.gz')
-                    with open(temp_tar_path, 'rb') as f_in:
-                        import gzip
-                        with gzip.open(archive_path, 'wb') as f_out:
-                            shutil.copyfileobj(f_in, f_out)
-                    temp_tar_path.unlink()
-                    logger.info(f"Created gzip archive: {archive_path.name}")
-                    
-            except (ImportError, FileNotFoundError):
-                # zstd not available, use gzip
-                archive_path = archive_path.with_suffix('.tar.gz')
-                with open(temp_tar_path, 'rb') as f_in:
-                    import gzip
-                    with gzip.open(archive_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                temp_tar_path.unlink()
-                logger.info(f"Created gzip archive: {archive_path.name}")
+                compressed = False
+                if ZSTD_PATH:
+                    compressed = self._write_zstd_archive(entries, partial_path, level, threads)
+                if not compressed:
+                    archive_path = self.archives_path / f"{date_str}.tar.gz"
+                    self._write_gzip_archive(entries, partial_path, level)
+                os.replace(partial_path, archive_path)
+            finally:
+                partial_path.unlink(missing_ok=True)
+            logger.info(f"Created {'zstd' if compressed else 'gzip'} archive: {archive_path.name}")
+            
+            # Archives are cold from here on: one fsync, then release their cached pages
+            _flush_and_drop_cache(archive_path)
             
             # Remove original directory after successful archiving
-            shutil.rmtree(date_dir)
+            _remove_archived_tree(date_dir, [entry.path for entry in entries])
             logger.info(f"Archived and removed directory: {date_str}")
             
             return True
@@ -111,40 +313,48 @@ class ArchiveManager:
             yesterday = datetime.now() - timedelta(days=1)
             archive_cutoff = yesterday - timedelta(days=7)  # Archive data older than 7 days
             
-            if self.frames_path.exists():
-                for date_dir in self.frames_path.iterdir():
-                    if not date_dir.is_dir():
-                        continue
-                    
-                    try:
-                        date = datetime.strptime(date_dir.name, "%Y-%m-%d")
-                        if date < archive_cutoff:
-                            if self.archive_date(date):
-                                results['archived_dates'].append(date_dir.name)
-                            else:
-                                results['errors'].append(f"Failed to archive {date_dir.name}")
-                    except ValueError:
-                        # Not a date directory
-                        continue
+            # One readdir per tree; DirEntry type checks are served from it without extra stats
+            dates_to_archive = []
+            for date_name in self._list_entries(self.frames_path, dirs=True):
+                date = _parse_date_name(date_name)
+                if date is not None and date < archive_cutoff:
+                    dates_to_archive.append(date)
+            
+            # Dates are independent and compression is CPU-bound (zstd subprocess or zlib,
+            # both outside the GIL), so archive several at once. Even a single date goes
+            # through the pool so it too compresses at idle priority
+            outcomes = []
+            if dates_to_archive:
+                workers = min(ARCHIVE_WORKERS, len(dates_to_archive))
+                # Split the core budget between jobs instead of each zstd taking every core
+                threads = max(1, ARCHIVE_WORKERS // workers)
+                with ThreadPoolExecutor(max_workers=workers, initializer=_lower_thread_priority) as executor:
+                    outcomes = list(executor.map(
+                        lambda date: self.archive_date(date, threads), dates_to_archive))
+            
+            for date, archived in zip(dates_to_archive, outcomes):
+                date_name = date.strftime("%Y-%m-%d")
+                if archived:
+                    results['archived_dates'].append(date_name)
+                else:
+                    results['errors'].append(f"Failed to archive {date_name}")
             
             # Remove old archives
-            if self.archives_path.exists():
-                for archive_file in self.archives_path.glob("*.tar.*"):
-                    try:
-                        # Extract date from filename
-                        date_str = archive_file.stem.split('.')[0]  # Remove .tar.zst or .tar.gz
-                        archive_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        
-                        if archive_date < cutoff_date:
-                            archive_file.unlink()
-                            results['removed_archives'].append(archive_file.name)
-                            logger.info(f"Removed old archive: {archive_file.name}")
-                            
-                    except (ValueError, OSError) as e:
-                        results['errors'].append(f"Failed to process archive {archive_file.name}: {e}")
-            
-            # Clean up database records
+            for archive_name in self._list_entries(self.archives_path, dirs=False):
+                archive_date = _parse_date_name(archive_name, archive=True)
+                if archive_date is None or archive_date >= cutoff_date:
+                    continue
+                
+                try:
+                    os.unlink(self.archives_path / archive_name)
+                    results['removed_archives'].append(archive_name)
+                    logger.info(f"Removed old archive: {archive_name}")
+                except OSError as e:
+                    results['errors'].append(f"Failed to process archive {archive_name}: {e}")
+            
+            # Clean up database records, then refresh planner statistics for the new table shape
             db.cleanup_old_records(max_age)
+            db.analyze()
             
             logger.info(f"Cleanup completed: archived {len(results['archived_dates'])} dates, "
                        f"removed {len(results['removed_archives'])} old archives")
@@ -162,39 +372,43 @@ class ArchiveManager:
             'total_size_mb': 0,
             'oldest_archive': None,
             'newest_archive': None,
-            'archives_by_month': {}
+            'archives_by_month': {},
+            'frame_files': 0,
+            'frames_size_mb': 0
         }
         
         try:
-            if not self.archives_path.exists():
-                return stats
-            
-            archive_files = list(self.archives_path.glob("*.tar.*"))
-            stats['total_archives'] = len(archive_files)
-            
-            if not archive_files:
-                return stats
-            
             dates = []
             total_size = 0
             
-            for archive_file in archive_files:
+            # One pass over the directory: names, types and sizes all come from the DirEntry
+            with os.scandir(self.archives_path) as entries:
+                archive_entries = [e for e in entries
+                                   if '.tar.' in e.name and e.is_file(follow_symlinks=False)]
+            
+            for entry in archive_entries:
+                stats['total_archives'] += 1
+                
                 try:
                     # Get file size
-                    size = archive_file.stat().st_size
-                    total_size += size
-                    
-                    # Extract date
-                    date_str = archive_file.stem.split('.')[0]
-                    date = datetime.strptime(date_str, "%Y-%m-%d")
-                    dates.append(date)
-                    
-                    # Count by month
-                    month_key = date.strftime("%Y-%m")
-                    stats['archives_by_month'][month_key] = stats['archives_by_month'].get(month_key, 0) + 1
-                    
-                except (ValueError, OSError):
+                    total_size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
                     continue
+                
+                # Extract date
+                date = _parse_date_name(entry.name, archive=True)
+                if date is None:
+                    continue
+                dates.append(date)
+                
+                # Count by month
+                month_key = f"{date.year:04d}-{date.month:02d}"
+                stats['archives_by_month'][month_key] = stats['archives_by_month'].get(month_key, 0) + 1
+            
+            # Unarchived frames, counted and sized in the same single walk
+            frame_files, frame_bytes = _scan_dir_stats(self.frames_path)
+            stats['frame_files'] = frame_files
+            stats['frames_size_mb'] = round(frame_bytes / (1024 * 1024), 2)
             
             if dates:
                 stats['oldest_archive'] = min(dates).strftime("%Y-%m-%d")
@@ -219,11 +433,15 @@ class ArchiveManager:
             output_dir.mkdir(parents=True, exist_ok=True)
             
             if archive_name.endswith('.tar.zst'):
+                if not ZSTD_PATH:
+                    logger.error(f"zstd is not installed, cannot extract {archive_name}")
+                    return False
+                
                 # Extract zstd archive
                 import subprocess
                 result = subprocess.run([
-                    'zstd', '-d', str(archive_path), '-c'
-                ], capture_output=True)
+                    ZSTD_PATH, '-d', str(archive_path), '-c'
+                ], capture_output=True, timeout=ARCHIVE_TOOL_TIMEOUT)
                 
                 if result.returncode != 0:
                     logger.error(f"Failed to decompress zstd archive: {result.stderr}")
@@ -261,6 +479,8 @@ def main():
     parser.add_argument("--archive-date", type=str, help="Archive specific date (YYYY-MM-DD)")
     parser.add_argument("--stats", action="store_true", help="Show archive statistics")
     parser.add_argument("--extract", type=str, help="Extract specific archive")
+    parser.add_argument("--vacuum", action="store_true", help="Reclaim free database pages")
+    parser.add_argument("--full", action="store_true", help="With --vacuum, rewrite the whole database file")
     parser.add_argument("--max-age", type=int, help="Maximum age in days for cleanup")
     
     args = parser.parse_args()
@@ -287,6 +507,10 @@ def main():
             stats = manager.get_archive_stats()
             print(f"Archive statistics: {json.dumps(stats, indent=2)}")
             
+        elif args.vacuum:
+            results = db.vacuum(full=args.full)
+            print(f"Vacuum results: {json.dumps(results, indent=2)}")
+            
         elif args.extract:
             success = manager.extract_archive(args.extract)
             print(f"Extraction {'successful' if success else 'failed'}")
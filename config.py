@@ -61,9 +61,12 @@ class TelegramConfig:
     """Telegram bot settings"""
     bot_token: str = ""
     chat_id: str = ""  # Can be negative for groups
-    rate_limit_delay: float = 2.0  # Minimum seconds between messages
     max_retries: int = 3
     retry_backoff: float = 2.0  # Exponential backoff multiplier
+    alert_cooldown: float = 15.0  # Minimum seconds between motion alert uploads
+    poll_timeout: int = 50  # Long-poll seconds per getUpdates (Telegram allows up to 50)
+    webhook_url: str = ""  # Public HTTPS base URL; enables webhook mode instead of polling
+    webhook_port: int = 8443  # Local port the webhook server listens on
 
 
 @dataclass
@@ -81,6 +84,10 @@ class StorageConfig:
     # Cleanup settings
     max_age_days: int = 30
     max_disk_usage_percent: float = 80.0
+    
+    # Archive compression (zstd/gzip level). Frames are already JPEG, so higher
+    # levels cost a lot of CPU for almost no size gain
+    archive_compression_level: int = 1
 
 
 @dataclass
@@ -121,6 +128,12 @@ class Config:
         self.telegram.chat_id = os.getenv("TELEGRAM_CHAT_ID", "")
         
         # Optional overrides
+        if os.getenv("TELEGRAM_WEBHOOK_URL"):
+            self.telegram.webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+        
+        if os.getenv("TELEGRAM_WEBHOOK_PORT"):
+            self.telegram.webhook_port = int(os.getenv("TELEGRAM_WEBHOOK_PORT"))
+        
         if os.getenv("MOTION_THRESHOLD"):
             self.motion.motion_threshold = int(os.getenv("MOTION_THRESHOLD"))
         
@@ -139,6 +152,9 @@ class Config:
         if os.getenv("ML_FRAMES_PATH"):
             self.storage.ml_frames_path = os.getenv("ML_FRAMES_PATH")
         
+        if os.getenv("ARCHIVE_COMPRESSION_LEVEL"):
+            self.storage.archive_compression_level = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL"))
+        
         if os.getenv("LOG_LEVEL"):
             self.system.log_level = os.getenv("LOG_LEVEL")
     
@@ -5,15 +5,96 @@ SQLite database for storing detection events and metadata.
 
 import sqlite3
 import logging
+from contextlib import contextmanager
+from queue import Queue, Empty, Full
+from threading import Lock
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Iterator, List, Optional, Tuple
 from dataclasses import dataclass
 
 from config import config
 
 logger = logging.getLogger(__name__)
 
+# Per-connection tuning: WAL-friendly durability, in-memory temp tables,
+# ~20MB page cache, memory-mapped reads and a lock wait instead of SQLITE_BUSY
+CONNECTION_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA busy_timeout=5000;
+"""
+
+# Idle connections kept open for reuse
+POOL_SIZE = 4
+
+# Statement text shared by every call so the per-connection statement cache
+# (keyed on the SQL string) keeps them compiled
+# OR IGNORE: a duplicate millisecond drops only that row, not the whole event's batch
+_SQL_INSERT_DETECTION = """
+    INSERT OR IGNORE INTO detections
+    (ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_SELECT_RANGE = """
+    SELECT ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path
+    FROM detections
+    WHERE ts >= ? AND ts < ?
+    ORDER BY ts
+"""
+_SQL_SELECT_RECENT = """
+    SELECT ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path
+    FROM detections
+    ORDER BY ts DESC
+    LIMIT ?
+"""
+_SQL_DELETE_OLDER = "DELETE FROM detections WHERE ts < ?"
+_SQL_COUNT_ALL = "SELECT COUNT(*) FROM detections"
+_SQL_COUNT_SINCE = "SELECT COUNT(*) FROM detections WHERE ts >= ?"
+_SQL_TS_RANGE = "SELECT MIN(ts), MAX(ts) FROM detections"
+
+# Startup script, run in one executescript call:
+# - auto_vacuum only takes effect on a fresh file (before any table exists); lets
+#   cleanup return freed pages with incremental_vacuum instead of a full VACUUM
+# - WAL is persistent in the file; lets the motion service write while the bot reads
+# - the ts PRIMARY KEY already provides the index every query uses, so the duplicate
+#   one older databases were created with is dropped
+SCHEMA_SCRIPT = """
+    PRAGMA auto_vacuum=INCREMENTAL;
+    PRAGMA journal_mode=WAL;
+    CREATE TABLE IF NOT EXISTS detections (
+        ts INTEGER PRIMARY KEY,
+        bbox_x INTEGER NOT NULL,
+        bbox_y INTEGER NOT NULL,
+        bbox_w INTEGER NOT NULL,
+        bbox_h INTEGER NOT NULL,
+        confidence REAL DEFAULT 1.0,
+        img_path TEXT
+    );
+    DROP INDEX IF EXISTS idx_detections_ts;
+"""
+
+# Free-page fraction below which a requested full VACUUM is not worth the rewrite
+VACUUM_MIN_FRAGMENTATION = 0.10
+
+# Version 2 stores ts as INTEGER unix milliseconds instead of datetime text
+SCHEMA_VERSION = 2
+
+
+def to_ms(timestamp: datetime) -> int:
+    """Convert a datetime to the unix-ms integer stored in the ts column"""
+    # Whole seconds and truncated microseconds separately: exact, unlike scaling the
+    # float timestamp, and the same rule the schema migration applies in SQL
+    seconds = int(timestamp.replace(microsecond=0).timestamp())
+    return seconds * 1000 + timestamp.microsecond // 1000
+
+
+def from_ms(ms: int) -> datetime:
+    """Convert a stored unix-ms integer back to a local datetime"""
+    return datetime.fromtimestamp(ms / 1000)
+
 
 @dataclass
 class Detection:
@@ -32,86 +113,142 @@ class DatabaseManager:
     
     def __init__(self, db_path: Optional[Path] = None):
         self.db_path = db_path or config.get_database_path()
+        self._pool: Queue = Queue(maxsize=POOL_SIZE)
         self._ensure_database()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with the standard pragmas applied"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.executescript(CONNECTION_PRAGMAS)
+        return conn
+    
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection; commits on success, rolls back on error"""
+        try:
+            conn = self._pool.get_nowait()
+        except Empty:
+            conn = self._connect()
+        
+        try:
+            with conn:
+                yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except Full:
+                conn.close()
+    
     def _ensure_database(self):
         """Create database and tables if they don't exist"""
         # Ensure parent directory exists
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS detections (
-                    ts DATETIME PRIMARY KEY,
+        with self._connection() as conn:
+            conn.executescript(SCHEMA_SCRIPT)
+            self._check_schema_upgrade(conn)
+            
+            logger.info(f"Database initialized at {self.db_path}")
+    
+    def _check_schema_upgrade(self, conn: sqlite3.Connection):
+        """Bring an existing database up to SCHEMA_VERSION"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        
+        column_type = conn.execute(
+            "SELECT type FROM pragma_table_info('detections') WHERE name = 'ts'"
+        ).fetchone()[0]
+        
+        if column_type.upper() != "INTEGER":
+            # Rebuild the table: ts text was written in local time, so convert via 'utc'.
+            # SQLite date functions round to the millisecond, so feed them only the whole
+            # seconds and take the milliseconds straight from the text, truncating like to_ms
+            logger.info("Migrating detection timestamps to integer milliseconds")
+            conn.executescript("""
+                BEGIN;
+                ALTER TABLE detections RENAME TO detections_old;
+                CREATE TABLE detections (
+                    ts INTEGER PRIMARY KEY,
                     bbox_x INTEGER NOT NULL,
                     bbox_y INTEGER NOT NULL,
                     bbox_w INTEGER NOT NULL,
                     bbox_h INTEGER NOT NULL,
                     confidence REAL DEFAULT 1.0,
                     img_path TEXT
-                )
-            """)
-            
-            # Create index for faster queries
-            conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_detections_ts 
-                ON detections(ts)
+                );
+                INSERT OR IGNORE INTO detections
+                SELECT CAST(strftime('%s', substr(ts, 1, 19), 'utc') AS INTEGER) * 1000
+                           + CAST(substr(substr(ts, 21) || '000', 1, 3) AS INTEGER),
+                       bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path
+                FROM detections_old;
+                DROP TABLE detections_old;
+                COMMIT;
             """)
-            
-            conn.commit()
-            logger.info(f"Database initialized at {self.db_path}")
+        
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     
     def insert_detection(self, detection: Detection) -> bool:
         """Insert a new detection record"""
+        return self.insert_detections([detection])
+    
+    def insert_detections(self, detections: List[Detection]) -> bool:
+        """Insert several detection records in a single transaction"""
+        if not detections:
+            return True
+        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT INTO detections 
-                    (ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    detection.timestamp,
+            with self._connection() as conn:
+                cursor = conn.executemany(_SQL_INSERT_DETECTION, [(
+                    to_ms(detection.timestamp),
                     detection.bbox_x,
                     detection.bbox_y,
                     detection.bbox_w,
                     detection.bbox_h,
                     detection.confidence,
                     detection.img_path
-                ))
-                conn.commit()
-                logger.debug(f"Inserted detection at {detection.timestamp}")
+                ) for detection in detections])
+                if cursor.rowcount < len(detections):
+                    logger.warning(f"Skipped {len(detections) - cursor.rowcount} detection(s) "
+                                   f"with duplicate timestamps")
+                logger.debug(f"Inserted {cursor.rowcount} detection(s)")
                 return True
         except sqlite3.Error as e:
-            logger.error(f"Failed to insert detection: {e}")
+            logger.error(f"Failed to insert detections: {e}")
             return False
     
-    def get_detections_by_date(self, date: datetime) -> List[Detection]:
-        """Get all detections for a specific date"""
+    @staticmethod
+    def _row_to_detection(row: tuple) -> Detection:
+        """Build a Detection from a (ts, bbox..., confidence, img_path) row"""
+        return Detection(
+            timestamp=from_ms(row[0]),
+            bbox_x=row[1],
+            bbox_y=row[2],
+            bbox_w=row[3],
+            bbox_h=row[4],
+            confidence=row[5],
+            img_path=row[6]
+        )
+    
+    def iter_detections_by_date(self, date: datetime) -> Iterator[Detection]:
+        """Yield detections for a specific date straight off the cursor (raises sqlite3.Error)"""
         start_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
         end_date = start_date + timedelta(days=1)
         
+        with self._connection() as conn:
+            for row in conn.execute(_SQL_SELECT_RANGE, (to_ms(start_date), to_ms(end_date))):
+                yield self._row_to_detection(row)
+    
+    def iter_recent_detections(self, limit: int = 10) -> Iterator[Detection]:
+        """Yield the most recent detections straight off the cursor (raises sqlite3.Error)"""
+        with self._connection() as conn:
+            for row in conn.execute(_SQL_SELECT_RECENT, (limit,)):
+                yield self._row_to_detection(row)
+    
+    def get_detections_by_date(self, date: datetime) -> List[Detection]:
+        """Get all detections for a specific date"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path
-                    FROM detections
-                    WHERE ts >= ? AND ts < ?
-                    ORDER BY ts
-                """, (start_date, end_date))
-                
-                detections = []
-                for row in cursor.fetchall():
-                    detections.append(Detection(
-                        timestamp=datetime.fromisoformat(row[0]),
-                        bbox_x=row[1],
-                        bbox_y=row[2],
-                        bbox_w=row[3],
-                        bbox_h=row[4],
-                        confidence=row[5],
-                        img_path=row[6]
-                    ))
-                
-                return detections
+            return list(self.iter_detections_by_date(date))
         except sqlite3.Error as e:
             logger.error(f"Failed to get detections by date: {e}")
             return []
@@ -119,27 +256,7 @@ class DatabaseManager:
     def get_recent_detections(self, limit: int = 10) -> List[Detection]:
         """Get the most recent detections"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    SELECT ts, bbox_x, bbox_y, bbox_w, bbox_h, confidence, img_path
-                    FROM detections
-                    ORDER BY ts DESC
-                    LIMIT ?
-                """, (limit,))
-                
-                detections = []
-                for row in cursor.fetchall():
-                    detections.append(Detection(
-                        timestamp=datetime.fromisoformat(row[0]),
-                        bbox_x=row[1],
-                        bbox_y=row[2],
-                        bbox_w=row[3],
-                        bbox_h=row[4],
-                        confidence=row[5],
-                        img_path=row[6]
-                    ))
-                
-                return detections
+            return list(self.iter_recent_detections(limit))
         except sqlite3.Error as e:
             logger.error(f"Failed to get recent detections: {e}")
             return []
@@ -150,55 +267,124 @@ class DatabaseManager:
         cutoff_date = datetime.now() - timedelta(days=max_age)
         
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.execute("""
-                    DELETE FROM detections
-                    WHERE ts < ?
-                """, (cutoff_date,))
+            with self._connection() as conn:
+                # Take the write lock up front: busy_timeout then waits out a concurrent
+                # insert instead of failing with SQLITE_BUSY when a deferred read
+                # transaction tries to upgrade mid-delete
+                conn.execute("BEGIN IMMEDIATE")
+                cursor = conn.execute(_SQL_DELETE_OLDER, (to_ms(cutoff_date),))
                 
                 deleted_count = cursor.rowcount
-                conn.commit()
                 
                 if deleted_count > 0:
                     logger.info(f"Cleaned up {deleted_count} old detection records")
+                    # executescript commits the delete and runs the pragma to completion;
+                    # a plain execute() only steps it once and frees a single page
+                    conn.executescript("PRAGMA incremental_vacuum(1000);")
                 
                 return deleted_count
         except sqlite3.Error as e:
             logger.error(f"Failed to cleanup old records: {e}")
             return 0
     
+    def analyze(self) -> bool:
+        """Refresh query planner statistics (sqlite_stat1)"""
+        try:
+            with self._connection() as conn:
+                conn.execute("ANALYZE")
+                return True
+        except sqlite3.Error as e:
+            logger.error(f"Failed to analyze database: {e}")
+            return False
+    
+    def vacuum(self, full: bool = False, min_fragmentation: float = VACUUM_MIN_FRAGMENTATION) -> dict:
+        """Return free pages to the filesystem; full=True rewrites the whole file with VACUUM
+        
+        A full VACUUM is skipped when free pages are below min_fragmentation of the file.
+        """
+        stats = {"mode": "full" if full else "incremental", "freed_pages": 0, "skipped": False}
+        
+        try:
+            with self._connection() as conn:
+                freelist_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+                fragmentation = freelist_before / page_count if page_count else 0.0
+                stats["fragmentation"] = round(fragmentation, 3)
+                
+                if full and fragmentation < min_fragmentation:
+                    logger.info(f"Skipping full VACUUM: fragmentation {fragmentation:.1%} "
+                                f"below {min_fragmentation:.0%}")
+                    full = False
+                    stats["mode"] = "incremental"
+                    stats["skipped"] = True
+                
+                # auto_vacuum=2 is INCREMENTAL; databases created before it was the default
+                # need a single full VACUUM for the setting to take effect
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    logger.info("Converting database to incremental auto_vacuum")
+                    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    full = True
+                    stats["mode"] = "full"
+                    stats["skipped"] = False
+                
+                # executescript runs outside a transaction, as VACUUM requires, and steps
+                # incremental_vacuum to completion
+                if full:
+                    conn.executescript("VACUUM;")
+                else:
+                    conn.executescript("PRAGMA incremental_vacuum;")
+                
+                stats["freed_pages"] = freelist_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                
+                # Cheap planner statistics refresh, only where SQLite thinks it is needed
+                conn.execute("PRAGMA optimize")
+                
+                logger.info(f"Vacuum ({stats['mode']}) freed {stats['freed_pages']} pages")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to vacuum database: {e}")
+            stats["error"] = str(e)
+        
+        return stats
+    
     def get_stats(self) -> dict:
         """Get database statistics"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._connection() as conn:
                 # Total detections
-                cursor = conn.execute("SELECT COUNT(*) FROM detections")
+                cursor = conn.execute(_SQL_COUNT_ALL)
                 total_detections = cursor.fetchone()[0]
                 
                 # Detections today
                 today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                cursor = conn.execute("""
-                    SELECT COUNT(*) FROM detections 
-                    WHERE ts >= ?
-                """, (today,))
+                cursor = conn.execute(_SQL_COUNT_SINCE, (to_ms(today),))
                 today_detections = cursor.fetchone()[0]
                 
                 # Date range
-                cursor = conn.execute("""
-                    SELECT MIN(ts), MAX(ts) FROM detections
-                """)
+                cursor = conn.execute(_SQL_TS_RANGE)
                 date_range = cursor.fetchone()
                 
                 return {
                     "total_detections": total_detections,
                     "today_detections": today_detections,
-                    "first_detection": date_range[0],
-                    "last_detection": date_range[1]
+                    "first_detection": from_ms(date_range[0]) if date_range[0] is not None else None,
+                    "last_detection": from_ms(date_range[1]) if date_range[1] is not None else None
                 }
         except sqlite3.Error as e:
             logger.error(f"Failed to get stats: {e}")
             return {}
 
 
-# Global database instance
-db = DatabaseManager()
+# Global database instance, created on first access (PEP 562) so importing this
+# module doesn't open the database or run the schema script
+_db = None
+_db_lock = Lock()
+
+
+def __getattr__(name: str):
+    global _db
+    if name == "db":
+        with _db_lock:
+            if _db is None:
+                _db = DatabaseManager()
+        return _db
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
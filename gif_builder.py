@@ -6,6 +6,8 @@ Creates motion alerts from captured frames with configurable output format.
 import cv2
 import numpy as np
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Tuple
@@ -13,11 +15,37 @@ import json
 import tempfile
 import subprocess
 
+try:
+    import orjson  # Optional C JSON decoder for frame metadata
+except ImportError:
+    orjson = None
+
 from PIL import Image, ImageSequence
 from config import config
 
 logger = logging.getLogger(__name__)
 
+# Threads decoding alert frames; each decode is a GIL-free OpenCV call
+FRAME_LOAD_WORKERS = os.cpu_count() or 2
+
+# Pixel stride when sampling frames to build the shared GIF palette
+GIF_PALETTE_SAMPLE_STEP = 4
+
+# A 16-frame alert encodes in a few seconds; anything longer means ffmpeg is stuck
+FFMPEG_TIMEOUT = 60
+
+
+def _parse_frame_timestamp(stem: str) -> datetime:
+    """Timestamp of a 'YYYYmmdd_HHMMSS_mmm_crop' frame name.
+    
+    Sliced by hand: strptime re-interprets its format string on every call.
+    """
+    if len(stem) != 24 or stem[8] != '_' or stem[15] != '_' or not stem.endswith('_crop'):
+        raise ValueError(f"Unexpected frame file name: {stem}")
+    return datetime(int(stem[0:4]), int(stem[4:6]), int(stem[6:8]),
+                    int(stem[9:11]), int(stem[11:13]), int(stem[13:15]),
+                    int(stem[16:19]) * 1000)
+
 
 class AlertBuilder:
     """Builds GIF or MP4 alerts from motion frames"""
@@ -26,41 +54,59 @@ class AlertBuilder:
         self.temp_dir = Path(tempfile.gettempdir()) / "turtlecam"
         self.temp_dir.mkdir(exist_ok=True)
     
-    def _load_frames_from_event(self, event_dir: Path) -> List[Tuple[datetime, np.ndarray, dict]]:
-        """Load frames from a motion event directory"""
-        frames = []
-        
-        # Find all crop files
-        crop_files = sorted(event_dir.glob("*_crop.jpg"))
-        
-        for crop_file in crop_files:
-            try:
-                # Load image
-                img = cv2.imread(str(crop_file))
-                if img is None:
-                    continue
-                
-                # Convert BGR to RGB
-                img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                
-                # Load metadata
-                meta_file = crop_file.with_name(crop_file.stem.replace("_crop", "_meta") + ".json")
-                metadata = {}
-                if meta_file.exists():
+    def _load_frame(self, crop_file: Path) -> Optional[Tuple[datetime, np.ndarray, dict]]:
+        """Decode one crop and its metadata; None if it can't be read"""
+        try:
+            # Load image
+            img = cv2.imread(str(crop_file))
+            if img is None:
+                return None
+            
+            # Downscale right after decode: the color conversion then touches fewer
+            # pixels and the frame list holds alert-sized images, not full crops
+            img = self._resize_frame(img)
+            
+            # Convert BGR to RGB
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            
+            # Load metadata
+            meta_file = crop_file.with_name(crop_file.stem.replace("_crop", "_meta") + ".json")
+            metadata = {}
+            if meta_file.exists():
+                if orjson is not None:
+                    metadata = orjson.loads(meta_file.read_bytes())
+                else:
                     with open(meta_file, 'r') as f:
                         metadata = json.load(f)
-                
-                # Parse timestamp from filename
-                timestamp_str = crop_file.stem.replace("_crop", "")
-                timestamp = datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S_%f")
-                
-                frames.append((timestamp, img_rgb, metadata))
-                
-            except Exception as e:
-                logger.warning(f"Failed to load frame {crop_file}: {e}")
-                continue
-        
-        return frames
+            
+            # Parse timestamp from filename
+            timestamp = _parse_frame_timestamp(crop_file.stem)
+            
+            return (timestamp, img_rgb, metadata)
+            
+        except Exception as e:
+            logger.warning(f"Failed to load frame {crop_file}: {e}")
+            return None
+    
+    def _list_crop_files(self, event_dir: Path) -> List[Path]:
+        """List crop files in a directory, oldest first"""
+        # One scandir; the name filter needs no stat or Path per entry
+        with os.scandir(event_dir) as entries:
+            return sorted(Path(e.path) for e in entries if e.name.endswith("_crop.jpg"))
+    
+    def _load_frames_from_event(self, event_dir: Path) -> List[Tuple[datetime, np.ndarray, dict]]:
+        """Load frames from a motion event directory"""
+        return self._load_frames(self._list_crop_files(event_dir))
+    
+    def _load_frames(self, crop_files: List[Path]) -> List[Tuple[datetime, np.ndarray, dict]]:
+        """Decode a batch of crop files, keeping their order"""
+        if not crop_files:
+            return []
+    
+        # JPEG decode and resize run in OpenCV with the GIL released, so frames
+        # decode in parallel; map() keeps them in file order
+        with ThreadPoolExecutor(max_workers=min(FRAME_LOAD_WORKERS, len(crop_files))) as executor:
+            return [frame for frame in executor.map(self._load_frame, crop_files) if frame is not None]
     
     def _resize_frame(self, frame: np.ndarray, max_width: int = None) -> np.ndarray:
         """Resize frame while maintaining aspect ratio"""
@@ -107,27 +153,34 @@ class AlertBuilder:
             # Decimate frames if necessary
             frames = self._decimate_frames(frames)
             
-            # Prepare PIL images
-            pil_images = []
-            for timestamp, frame, metadata in frames:
-                # Resize frame
-                resized_frame = self._resize_frame(frame)
-                
-                # Convert to PIL Image
-                pil_img = Image.fromarray(resized_frame)
-                pil_images.append(pil_img)
+            resized_frames = [self._resize_frame(frame) for _, frame, _ in frames]
+            
+            # One palette for the whole clip, built with the fast octree quantizer from
+            # a subsample of every frame. Saving RGB frames would run median cut per frame
+            sample = np.concatenate([
+                f[::GIF_PALETTE_SAMPLE_STEP, ::GIF_PALETTE_SAMPLE_STEP].reshape(-1, 3)
+                for f in resized_frames
+            ])
+            palette = Image.fromarray(sample[:, np.newaxis, :]).quantize(
+                colors=256, method=Image.FASTOCTREE)
+            
+            # Map frames onto it without dithering: faster, and flat areas stay flat,
+            # which LZW compresses much better between similar frames
+            pil_images = [
+                Image.fromarray(f).quantize(palette=palette, dither=Image.NONE)
+                for f in resized_frames
+            ]
             
             # Calculate frame duration in milliseconds
             frame_duration = int(1000 / config.alert.target_fps)
             
-            # Save as animated GIF
+            # Save as animated GIF (palette is already minimal, so skip the optimize pass)
             pil_images[0].save(
                 output_path,
                 save_all=True,
                 append_images=pil_images[1:],
                 duration=frame_duration,
-                loop=0,  # Infinite loop
-                optimize=True
+                loop=0  # Infinite loop
             )
             
             logger.info(f"Created GIF: {output_path} ({len(pil_images)} frames)")
@@ -146,30 +199,30 @@ class AlertBuilder:
             
             # Decimate frames if necessary
             frames = self._decimate_frames(frames)
+            resized_frames = [self._resize_frame(frame) for _, frame, _ in frames]
             
-            # Create temporary directory for frames
-            temp_frames_dir = self.temp_dir / f"frames_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            temp_frames_dir.mkdir(exist_ok=True)
-            
-            # Save frames as individual images
-            frame_paths = []
-            for i, (timestamp, frame, metadata) in enumerate(frames):
-                # Resize frame
-                resized_frame = self._resize_frame(frame)
-                
-                # Convert RGB to BGR for OpenCV
-                frame_bgr = cv2.cvtColor(resized_frame, cv2.COLOR_RGB2BGR)
-                
-                # Save frame
-                frame_path = temp_frames_dir / f"frame_{i:04d}.jpg"
-                cv2.imwrite(str(frame_path), frame_bgr, [cv2.IMWRITE_JPEG_QUALITY, config.alert.quality])
-                frame_paths.append(frame_path)
+            # Raw video has one fixed size; yuv420p also needs even dimensions
+            height, width = resized_frames[0].shape[:2]
+            width -= width % 2
+            height -= height % 2
+            
+            # Pipe raw RGB frames to ffmpeg instead of encoding temporary JPEGs for it
+            # to decode again
+            raw = b"".join(
+                (frame if frame.shape[:2] == (height, width)
+                 else cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)).tobytes()
+                for frame in resized_frames
+            )
             
             # Build ffmpeg command
             ffmpeg_cmd = [
                 "ffmpeg", "-y",  # Overwrite output
+                "-loglevel", "error",
+                "-f", "rawvideo",
+                "-pix_fmt", "rgb24",
+                "-s", f"{width}x{height}",
                 "-framerate", str(config.alert.target_fps),
-                "-i", str(temp_frames_dir / "frame_%04d.jpg"),
+                "-i", "-",
                 "-c:v", "libx264",
                 "-pix_fmt", "yuv420p",
                 "-crf", "23",  # Good quality
@@ -177,21 +230,18 @@ class AlertBuilder:
             ]
             
             # Run ffmpeg
-            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                logger.info(f"Created MP4: {output_path} ({len(frames)} frames)")
-                success = True
-            else:
-                logger.error(f"ffmpeg failed: {result.stderr}")
-                success = False
+            try:
+                result = subprocess.run(ffmpeg_cmd, input=raw, capture_output=True, timeout=FFMPEG_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logger.error(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s")
+                return False
             
-            # Cleanup temporary frames
-            for frame_path in frame_paths:
-                frame_path.unlink(missing_ok=True)
-            temp_frames_dir.rmdir()
+            if result.returncode != 0:
+                logger.error(f"ffmpeg failed: {result.stderr.decode(errors='replace')}")
+                return False
             
-            return success
+            logger.info(f"Created MP4: {output_path} ({len(resized_frames)} frames)")
+            return True
             
         except Exception as e:
             logger.error(f"Failed to create MP4: {e}")
@@ -206,20 +256,22 @@ class AlertBuilder:
                 logger.error("Frames directory does not exist")
                 return None
             
-            # Get recent date directories
-            date_dirs = sorted([d for d in frames_base.iterdir() if d.is_dir()], reverse=True)
+            # Get recent date directories (DirEntry.is_dir uses the d_type from readdir)
+            with os.scandir(frames_base) as entries:
+                date_dirs = sorted((Path(e.path) for e in entries if e.is_dir(follow_symlinks=False)),
+                                   reverse=True)
             
-            all_frames = []
+            # Pick the newest crops by filename (names sort by timestamp) so only
+            # the frames that end up in the alert get decoded, in one batch
+            selected = []
             for date_dir in date_dirs:
-                frames = self._load_frames_from_event(date_dir)
-                all_frames.extend(frames)
-                
-                if len(all_frames) >= frame_count:
+                if len(selected) >= frame_count:
                     break
+                crop_files = self._list_crop_files(date_dir)
+                selected = crop_files[-(frame_count - len(selected)):] + selected
             
-            # Take the most recent frames
-            all_frames = sorted(all_frames, key=lambda x: x[0], reverse=True)[:frame_count]
-            all_frames.reverse()  # Chronological order for playback
+            # Chronological order for playback
+            all_frames = self._load_frames(selected)
             
             if not all_frames:
                 logger.error("No recent frames found")
@@ -271,12 +323,17 @@ class AlertBuilder:
             current_time = time.time()
             max_age_seconds = max_age_hours * 3600
             
-            for file_path in self.temp_dir.glob("*"):
-                if file_path.is_file():
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > max_age_seconds:
-                        file_path.unlink()
-                        logger.debug(f"Cleaned up temp file: {file_path}")
+            # DirEntry strings and os calls; no Path objects or extra is_file() stats per entry
+            with os.scandir(self.temp_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    try:
+                        if current_time - entry.stat().st_mtime > max_age_seconds:
+                            os.unlink(entry.path)
+                            logger.debug(f"Cleaned up temp file: {entry.path}")
+                    except FileNotFoundError:
+                        continue
                         
         except Exception as e:
             logger.error(f"Failed to cleanup temp files: {e}")
@@ -189,6 +189,11 @@ ExecStart=/bin/bash -c 'find $DATA_DIR/frames -name "*.jpg" -mtime +1 -exec rm {
 StandardOutput=journal
 StandardError=journal
 
+# Housekeeping only; yield CPU and disk to the camera and bot services
+Nice=10
+CPUSchedulingPolicy=idle
+IOSchedulingClass=idle
+
 # Security hardening
 ProtectSystem=strict
 ReadWritePaths=$DATA_DIR
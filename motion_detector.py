@@ -6,32 +6,71 @@ Background subtraction-based motion detection optimized for Hermann's tortoise b
 import cv2
 import numpy as np
 import logging
+import os
 import time
 import gc
+import signal
+import weakref
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, Tuple, List
 from threading import Thread, Event
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
 import json
 
+try:
+    import orjson  # Optional C JSON encoder for frame metadata
+except ImportError:
+    orjson = None
+
 from picamera2 import Picamera2
 from config import config
 from database import db, Detection
 
 logger = logging.getLogger(__name__)
 
+# Turtle blob size range in pixels of the 320x240 localization frame
+MIN_TURTLE_AREA = 200
+MAX_TURTLE_AREA = 5000
+
+# Finished events waiting for the writer thread; when full the capture loop waits
+EVENT_QUEUE_SIZE = 4
+
+# Morphology kernels, built once instead of on every frame
+LOCALIZE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+COMPARE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+
+
+def _write_jpeg(path: Path, image: np.ndarray, quality: int):
+    """Encode image to JPEG in memory and write it with (normally) a single write() call"""
+    ok, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError(f"JPEG encoding failed for {path}")
+    data = memoryview(buf).cast('B')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # write() may return short (e.g. a filling disk); keep going until all bytes are out,
+        # a full disk then surfaces as OSError instead of a silently truncated JPEG
+        while data:
+            data = data[os.write(fd, data):]
+    except BaseException:
+        os.close(fd)
+        # Don't leave a partial JPEG that later stages would treat as a valid frame
+        Path(path).unlink(missing_ok=True)
+        raise
+    os.close(fd)
+
 
 class MotionFrame:
     """Container for a motion detection frame with metadata"""
     
-    def __init__(self, timestamp: datetime, motion_frame: np.ndarray, 
+    def __init__(self, timestamp: datetime, motion_frame: Optional[np.ndarray] = None, 
                  bbox: Optional[Tuple[int, int, int, int]] = None,
                  high_res_crop: Optional[np.ndarray] = None):
         self.timestamp = timestamp
-        self.motion_frame = motion_frame  # 4K frame used for motion detection
+        self.motion_frame = motion_frame  # Optional full frame; events only need the crop
         self.bbox = bbox  # (x, y, w, h) in motion coordinates
-        self.high_res_crop = high_res_crop  # Cropped section around motion
+        self.high_res_crop = high_res_crop  # Cropped section around motion, BGR for imwrite
         self.confidence = 1.0
 
 
@@ -42,6 +81,37 @@ class TurtleTracker:
         self.last_bbox = None
         self.tracking_confidence = 0
         self.template = None
+        self._downscales = {}  # id(frame) -> (weakref to frame, {name: downscaled array})
+    
+    def _cached(self, frame, name, make):
+        """Derived image of frame, computed once while frame is the current or previous frame.
+        
+        Each comparison pairs the new frame with the previous one, so without this every
+        full-resolution frame would be downscaled twice. Only the small derived arrays are
+        held; the weak reference (which also guards against id reuse) doesn't keep a
+        ~48MB source frame alive once the capture loop has let go of it.
+        """
+        entry = self._downscales.get(id(frame))
+        if entry is None or entry[0]() is not frame:
+            entry = (weakref.ref(frame), {})
+            self._downscales[id(frame)] = entry
+            # Only the two most recent frames are ever compared
+            while len(self._downscales) > 2:
+                del self._downscales[next(iter(self._downscales))]
+        
+        result = entry[1].get(name)
+        if result is None:
+            result = entry[1][name] = make(frame)
+        return result
+    
+    @staticmethod
+    def _tiny(frame):
+        return cv2.resize(frame, (80, 60), interpolation=cv2.INTER_NEAREST)
+    
+    @staticmethod
+    def _medium_gray(frame):
+        med = cv2.resize(frame, (320, 240), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(med, cv2.COLOR_RGB2GRAY)
         
     def track_turtle(self, current_frame, previous_frame):
         """Stable turtle tracking for consistent GIF crops"""
@@ -79,39 +149,40 @@ class TurtleTracker:
         """Optimized for turtle localization and stable crops"""
         try:
             # Stage 1: Fast motion detection on tiny frame
-            tiny1 = cv2.resize(frame1, (80, 60), interpolation=cv2.INTER_NEAREST)
-            tiny2 = cv2.resize(frame2, (80, 60), interpolation=cv2.INTER_NEAREST)
+            tiny1 = self._cached(frame1, "tiny", self._tiny)
+            tiny2 = self._cached(frame2, "tiny", self._tiny)
             
             diff_tiny = cv2.absdiff(tiny1, tiny2)
             if np.mean(diff_tiny) < 10:  # No motion
                 return False, None
             
-            # Stage 2: Localization on medium frame (for accurate bbox)
-            med1 = cv2.resize(frame1, (320, 240), interpolation=cv2.INTER_AREA)
-            med2 = cv2.resize(frame2, (320, 240), interpolation=cv2.INTER_AREA)
-            
-            # Convert to grayscale for contour detection
-            gray1 = cv2.cvtColor(med1, cv2.COLOR_RGB2GRAY)
-            gray2 = cv2.cvtColor(med2, cv2.COLOR_RGB2GRAY)
+            # Stage 2: Localization on medium grayscale frame (for accurate bbox)
+            gray1 = self._cached(frame1, "medium_gray", self._medium_gray)
+            gray2 = self._cached(frame2, "medium_gray", self._medium_gray)
             
             # Find difference and contours
             diff = cv2.absdiff(gray1, gray2)
             _, thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
             
+            # Too few changed pixels for the close to assemble a turtle-sized blob
+            # (half the minimum area, leaving room for gaps it fills): skip the rest
+            if cv2.countNonZero(thresh) < MIN_TURTLE_AREA // 2:
+                return False, None
+            
             # Clean up with morphology
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-            thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+            thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, LOCALIZE_KERNEL)
             
-            # Find contours
-            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Label blobs; areas and bounding boxes come back in one C pass
+            n, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
             
-            # Filter for turtle-sized objects
-            turtle_contours = [c for c in contours if 200 < cv2.contourArea(c) < 5000]
+            # Filter for turtle-sized objects (label 0 is the background)
+            areas = stats[1:n, cv2.CC_STAT_AREA]
+            candidates = np.flatnonzero((areas > MIN_TURTLE_AREA) & (areas < MAX_TURTLE_AREA))
             
-            if turtle_contours:
-                # Get largest turtle-like contour
-                largest = max(turtle_contours, key=cv2.contourArea)
-                x, y, w, h = cv2.boundingRect(largest)
+            if candidates.size:
+                # Get largest turtle-like blob
+                largest = 1 + candidates[areas[candidates].argmax()]
+                x, y, w, h = (int(v) for v in stats[largest, :4])
                 
                 # Scale back to full resolution
                 scale_x = frame1.shape[1] / 320
@@ -204,13 +275,28 @@ class MotionDetector:
         self.motion_frames = []
         self.last_motion_time = 0
         self.motion_event_active = False
-        self.last_capture_time = 0
+        self.last_capture_time = float('-inf')  # time.monotonic() of the last capture
         self.running = False  # Control flag for main loop
+        self._stop_event = Event()  # Wakes the main loop's waits immediately on stop()
         self.current_event_frames = []  # Store frames during motion events
         self.motion_event = Event()  # Threading event for motion detection
         self.turtle_tracker = TurtleTracker()  # Hybrid tracking system
+        self._created_dirs = set()  # Directories already created by this process
         # Initialize camera for still frame capture
         self._setup_camera()
+        
+        # Finished events are saved, recorded and alerted on a separate thread so the
+        # capture loop keeps running while JPEGs are encoded and the alert is sent
+        self._event_queue = Queue(maxsize=EVENT_QUEUE_SIZE)
+        self._event_writer = Thread(target=self._event_writer_loop, name="event-writer", daemon=True)
+        self._event_writer.start()
+        
+        # Alerts go through their own thread: a slow upload must not hold up saving the
+        # next event. One slot means alerts requested while one is being sent collapse
+        # into a single follow-up, which picks up the newest frames anyway
+        self._alert_queue = Queue(maxsize=1)
+        self._alert_sender = Thread(target=self._alert_sender_loop, name="alert-sender", daemon=True)
+        self._alert_sender.start()
     
     def _setup_camera(self):
         """Initialize Picamera2 with preview and full-res configurations"""
@@ -325,9 +411,8 @@ class MotionDetector:
             _, thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
             
             # Apply morphological operations to clean up noise
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-            thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-            thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+            thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, COMPARE_KERNEL)
+            thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, COMPARE_KERNEL)
             
             # Calculate percentage of changed pixels
             total_pixels = thresh.shape[0] * thresh.shape[1]
@@ -425,70 +510,95 @@ class MotionDetector:
                 new_height = int(cropped.shape[0] * scale_factor)
                 cropped = cv2.resize(cropped, (new_width, new_height), interpolation=cv2.INTER_AREA)
             
-            return cropped
+            # Crops are only ever written as JPEG, so convert to BGR here. The conversion
+            # allocates a new array, which also stops an un-resized crop (a view) from
+            # keeping the whole full-res frame alive for the length of the event
+            return cv2.cvtColor(cropped, cv2.COLOR_RGB2BGR)
             
         except Exception as e:
             logger.error(f"Failed to create high-res crop: {e}")
             return None
     
-    def _save_frame_data(self, motion_frame: MotionFrame):
-        """Save frame data to disk and database"""
+    def _ensure_dir(self, path: Path):
+        """Create a directory once per process instead of once per saved frame"""
+        if path not in self._created_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path)
+    
+    def _write_in_dir(self, directory: Path, write):
+        """Run write(); if a cached directory was removed underneath us, recreate it and retry once"""
+        try:
+            write()
+        except FileNotFoundError:
+            # e.g. archived by `archive_manager.py --archive-date` or cleaned up by hand
+            logger.warning(f"Directory {directory} disappeared, recreating it")
+            self._created_dirs.discard(directory)
+            self._ensure_dir(directory)
+            write()
+    
+    def _save_frame_data(self, motion_frame: MotionFrame) -> Optional[Detection]:
+        """Save frame data to disk and return its detection record for the database"""
         try:
             timestamp_str = motion_frame.timestamp.strftime("%Y%m%d_%H%M%S_%f")[:-3]
             date_str = motion_frame.timestamp.strftime("%Y-%m-%d")
             
             # Create date directory
             frames_dir = config.get_frames_path() / date_str
-            frames_dir.mkdir(parents=True, exist_ok=True)
+            self._ensure_dir(frames_dir)
             
             # Save high-resolution crop as JPEG
-            if motion_frame.high_res_crop is not None:
-                crop_filename = f"{timestamp_str}_crop.jpg"
-                crop_path = frames_dir / crop_filename
-                
-                # Convert to BGR for saving
-                crop_bgr = cv2.cvtColor(motion_frame.high_res_crop, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(str(crop_path), crop_bgr, [cv2.IMWRITE_JPEG_QUALITY, config.alert.quality])
-            else:
+            if motion_frame.high_res_crop is None:
                 logger.warning("No high-res crop available, skipping frame save")
-                return
-                
-                # Save metadata as JSON
-                metadata = {
-                    "timestamp": motion_frame.timestamp.isoformat(),
-                    "bbox": motion_frame.bbox,
-                    "confidence": motion_frame.confidence,
-                    "crop_path": str(crop_path)
-                }
-                
-                metadata_path = frames_dir / f"{timestamp_str}_meta.json"
+                return None
+            
+            crop_filename = f"{timestamp_str}_crop.jpg"
+            crop_path = frames_dir / crop_filename
+            
+            crop_bgr = motion_frame.high_res_crop
+            self._write_in_dir(frames_dir, lambda: _write_jpeg(crop_path, crop_bgr, config.alert.quality))
+            
+            # Save metadata as JSON
+            metadata = {
+                "timestamp": motion_frame.timestamp.isoformat(),
+                "bbox": motion_frame.bbox,
+                "confidence": motion_frame.confidence,
+                "crop_path": str(crop_path)
+            }
+            
+            metadata_path = frames_dir / f"{timestamp_str}_meta.json"
+            if orjson is not None:
+                metadata_path.write_bytes(orjson.dumps(
+                    metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+            else:
                 with open(metadata_path, 'w') as f:
                     json.dump(metadata, f, indent=2)
-                
-                # Save to database
-                if motion_frame.bbox:
-                    detection = Detection(
-                        timestamp=motion_frame.timestamp,
-                        bbox_x=motion_frame.bbox[0],
-                        bbox_y=motion_frame.bbox[1],
-                        bbox_w=motion_frame.bbox[2],
-                        bbox_h=motion_frame.bbox[3],
-                        confidence=motion_frame.confidence,
-                        img_path=str(crop_path)
-                    )
-                    db.insert_detection(detection)
-                
-                # Save ML training frame if enabled
-                if config.storage.save_ml_frames and config.get_ml_frames_path():
-                    ml_dir = config.get_ml_frames_path() / date_str
-                    ml_dir.mkdir(parents=True, exist_ok=True)
-                    ml_crop_path = ml_dir / crop_filename
-                    cv2.imwrite(str(ml_crop_path), crop_bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
-                
-                logger.debug(f"Saved frame data: {crop_filename}")
+            
+            # Save ML training frame if enabled
+            if config.storage.save_ml_frames and config.get_ml_frames_path():
+                ml_dir = config.get_ml_frames_path() / date_str
+                self._ensure_dir(ml_dir)
+                ml_crop_path = ml_dir / crop_filename
+                self._write_in_dir(ml_dir, lambda: _write_jpeg(ml_crop_path, crop_bgr, 95))
+            
+            logger.debug(f"Saved frame data: {crop_filename}")
+            
+            # Database row is written by the caller together with the rest of the event
+            if not motion_frame.bbox:
+                return None
+            
+            return Detection(
+                timestamp=motion_frame.timestamp,
+                bbox_x=motion_frame.bbox[0],
+                bbox_y=motion_frame.bbox[1],
+                bbox_w=motion_frame.bbox[2],
+                bbox_h=motion_frame.bbox[3],
+                confidence=motion_frame.confidence,
+                img_path=str(crop_path)
+            )
                 
         except Exception as e:
             logger.error(f"Failed to save frame data: {e}")
+            return None
     
     def _trigger_telegram_alert(self):
         """Trigger Telegram alert by calling the bot service"""
@@ -509,24 +619,50 @@ class MotionDetector:
             logger.error(f"Failed to trigger Telegram alert: {e}")
     
     def _process_motion_event(self):
-        """Process accumulated motion frames into alert"""
+        """Hand the accumulated motion frames to the writer thread"""
         if not self.current_event_frames:
             return
         
         logger.info(f"Processing motion event with {len(self.current_event_frames)} frames")
         
-        # Save all frames from the event
-        for frame in self.current_event_frames:
-            self._save_frame_data(frame)
+        # Swap in a fresh list; the writer thread owns the old one from here on
+        frames, self.current_event_frames = self.current_event_frames, []
+        self._event_queue.put(frames)
+    
+    def _event_writer_loop(self):
+        """Writer thread: save and alert on queued events until the None sentinel"""
+        while True:
+            frames = self._event_queue.get()
+            if frames is None:
+                break
+            try:
+                self._write_motion_event(frames)
+            except Exception as e:
+                logger.error(f"Failed to process motion event: {e}")
+    
+    def _write_motion_event(self, frames: List[MotionFrame]):
+        """Save an event's frames, record them and trigger the alert"""
+        # Save all frames from the event, then record them in one transaction
+        detections = []
+        for frame in frames:
+            detection = self._save_frame_data(frame)
+            if detection:
+                detections.append(detection)
+        db.insert_detections(detections)
         
         # Trigger GIF/video creation (handled by separate service)
         self.motion_event.set()
         
-        # Trigger Telegram alert directly
-        self._trigger_telegram_alert()
-        
-        # Clear event frames
-        self.current_event_frames.clear()
+        # Request a Telegram alert; skipped if one is already waiting to be sent
+        try:
+            self._alert_queue.put_nowait(True)
+        except Full:
+            logger.debug("Alert already pending, coalescing")
+    
+    def _alert_sender_loop(self):
+        """Alert thread: run the alert process for each request until the None sentinel"""
+        while self._alert_queue.get() is not None:
+            self._trigger_telegram_alert()
     
     def start(self):
         """Start motion detection"""
@@ -534,6 +670,7 @@ class MotionDetector:
             return
         
         self.running = True
+        self._stop_event.clear()
         logger.info("Starting motion detection")
         
         try:
@@ -541,24 +678,28 @@ class MotionDetector:
             
             # Let camera stabilize (auto-exposure/white-balance settle)
             logger.info("Camera stabilizing for 3 seconds...")
-            time.sleep(3)
+            self._stop_event.wait(3)
+            
+            # One wait per frame: the timelapse interval, never faster than motion_fps
+            frame_interval = max(config.camera.still_frame_interval, 1.0 / config.camera.motion_fps)
             
             while self.running:
-                current_time = time.time()
-                timestamp = datetime.now()
+                # Monotonic clock for intervals: immune to NTP steps and cheaper than datetime
+                current_time = time.monotonic()
                 
                 # Check if it's time to capture a new still frame (timelapse mode)
                 time_since_last = current_time - self.last_capture_time
-                if time_since_last < config.camera.still_frame_interval:
-                    remaining = config.camera.still_frame_interval - time_since_last
-                    if remaining > 1.0:  # Only log if more than 1 second remaining
-                        logger.debug(f"Timelapse waiting: {remaining:.1f}s until next frame")
-                    time.sleep(1.0)  # Sleep 1 second at a time for responsive logging
+                if time_since_last < frame_interval:
+                    remaining = frame_interval - time_since_last
+                    logger.debug(f"Timelapse waiting: {remaining:.1f}s until next frame")
+                    # Single wakeup per frame; stop() interrupts the wait
+                    self._stop_event.wait(remaining)
                     continue
                 
                 # Capture still frame (memory efficient single capture)
                 frame = self.camera.capture_array("main")
                 self.last_capture_time = current_time
+                timestamp = datetime.now()  # Wall clock only for file names and metadata
                 
                 logger.debug(f"Captured still frame at {timestamp}")
                 
@@ -603,10 +744,11 @@ class MotionDetector:
                     # Create high-resolution crop from 4K frame
                     high_res_crop = self._create_high_res_crop(frame, bbox)
                     
-                    # Create motion frame
+                    # Create motion frame. Only the crop is kept: capture_array() already
+                    # returns a fresh array, and holding (let alone copying) the full
+                    # ~48MB frame for every event frame was never used afterwards
                     motion_frame = MotionFrame(
                         timestamp=timestamp,
-                        motion_frame=frame.copy(),
                         bbox=bbox,
                         high_res_crop=high_res_crop
                     )
@@ -626,9 +768,6 @@ class MotionDetector:
                         logger.info("Motion event ended (timeout)")
                         self._process_motion_event()
                 
-                # Control frame rate
-                time.sleep(1.0 / config.camera.motion_fps)
-                
         except Exception as e:
             logger.error(f"Motion detection error: {e}")
         finally:
@@ -636,13 +775,24 @@ class MotionDetector:
                 self.camera.stop()
             logger.info("Motion detection stopped")
     
+    def request_stop(self):
+        """Ask the capture loop to exit without waiting for it; safe from a signal handler"""
+        self.running = False
+        self._stop_event.set()
+    
     def stop(self):
         """Stop motion detection"""
-        self.running = False
+        self.request_stop()
         
-        # Process any remaining event
+        # Process any remaining event, then let the writer finish everything queued
         if self.current_event_frames:
             self._process_motion_event()
+        if self._event_writer.is_alive():
+            self._event_queue.put(None)
+            self._event_writer.join()
+        if self._alert_sender.is_alive():
+            self._alert_queue.put(None)
+            self._alert_sender.join()
     
     def get_recent_frames(self, count: int = 10) -> List[MotionFrame]:
         """Get recent motion frames for manual GIF creation"""
@@ -689,9 +839,22 @@ def main():
         logger.error(f"Configuration errors: {errors}")
         sys.exit(1)
     
+    # OpenCV's SIMD (NEON) paths and worker pool can be disabled by the environment or
+    # a distro build; turn them on explicitly for the resize/encode-heavy capture path
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(os.cpu_count() or 1)
+    logger.info(f"OpenCV {cv2.__version__}: optimized={cv2.useOptimized()}, threads={cv2.getNumThreads()}")
+    
     # Create motion detector and start
     detector = MotionDetector()
     
+    # systemd stops the service with SIGTERM; end the loop so the pending event is still processed
+    def _handle_sigterm(signum, frame):
+        logger.info("Received SIGTERM")
+        detector.request_stop()
+    
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    
     try:
         detector.start()
     except KeyboardInterrupt:
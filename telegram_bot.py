@@ -4,24 +4,81 @@ Handles Telegram commands and sends motion alerts.
 """
 
 import asyncio
+import importlib.util
 import logging
+import secrets
+import signal
 import time
-from datetime import datetime
 from pathlib import Path
-from typing import Optional
-import os
 
-from telegram import Update, Bot
+from telegram import Update, InputFile
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram.error import TelegramError, RetryAfter
+from telegram.error import BadRequest, RetryAfter, NetworkError
+from telegram.request import HTTPXRequest
 
 from config import config
-from database import db
+import database
 from gif_builder import AlertBuilder
-from motion_detector import MotionDetector
 
 logger = logging.getLogger(__name__)
 
+# Upper bound for exponential backoff between send retries
+MAX_RETRY_BACKOFF = 60.0
+
+# Marker file (under the storage base path) whose mtime records the last motion alert
+ALERT_STAMP_FILE = ".last_motion_alert"
+
+# /status reply; paths and camera settings are filled once at startup, the
+# system readings per request
+STATUS_TEMPLATE = """
+🖥️ **System Status**
+
+Motion Detection: {motion_status}
+CPU Usage: {cpu_percent:.1f}%
+Memory Usage: {memory_percent:.1f}%
+Disk Usage: {disk_percent:.1f}%
+
+📁 Storage paths:
+- Frames: {frames_path}
+- Database: {database_path}
+- ML Frames: {ml_frames}
+
+⚙️ Camera settings:
+- Comparison: {comparison_width}x{comparison_height}
+- Full-res: {full_res_width}x{full_res_height}
+"""
+
+# URL path the webhook server listens on (webhook mode only)
+WEBHOOK_PATH = "turtlecam"
+
+# Connections kept open for outgoing bot API calls
+CONNECTION_POOL_SIZE = 8
+
+# Seconds to wait for a free pooled connection (PTB default is 1s, which fails
+# a command reply queued behind an upload)
+POOL_TIMEOUT = 10.0
+
+# Seconds allowed to write a request body; a multi-MB GIF over a Pi's uplink easily
+# exceeds PTB's 5s default and would be re-uploaded from scratch by the retry loop
+UPLOAD_WRITE_TIMEOUT = 60.0
+
+# Static /help reply, built once
+HELP_TEXT = """
+🐢 **TurtleCam Commands**
+
+/photo - Capture and send a full-resolution still image
+/snapshot - Still image with system status in one message
+/gif [N] - Create GIF from last N frames (default: 10)
+/stats - Show detection statistics
+/status - Show system status
+/help - Show this help message
+
+The bot will automatically send motion alerts when your turtle is active!
+"""
+
+# Seconds a /status system reading is reused for repeated requests
+STATUS_CACHE_TTL = 5.0
+
 
 class TurtleCamBot:
     """Telegram bot for turtle monitoring commands and alerts"""
@@ -29,8 +86,21 @@ class TurtleCamBot:
     def __init__(self):
         self.bot = None
         self.application = None
+        self.chat_id = None
         self.alert_builder = AlertBuilder()
         self.last_message_time = 0
+        self._status_cache = (0.0, None)  # (monotonic time, system status dict)
+        self._loop = None  # Event loop running start_polling
+        self._stop_event = None
+        self._status_static = {
+            "frames_path": config.get_frames_path(),
+            "database_path": config.get_database_path(),
+            "ml_frames": 'Enabled' if config.storage.save_ml_frames else 'Disabled',
+            "comparison_width": config.camera.comparison_width,
+            "comparison_height": config.camera.comparison_height,
+            "full_res_width": config.camera.full_res_width,
+            "full_res_height": config.camera.full_res_height,
+        }
         
         # Initialize bot
         self._setup_bot()
@@ -40,66 +110,136 @@ class TurtleCamBot:
         if not config.telegram.bot_token:
             raise ValueError("TELEGRAM_BOT_TOKEN is required")
         
-        self.application = Application.builder().token(config.telegram.bot_token).build()
+        # Numeric ids (negative for groups) parsed once; "@channel" names pass through
+        chat_id = config.telegram.chat_id.strip()
+        self.chat_id = int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+        
+        # Keep-alive pool shared by all send_* calls; HTTP/2 multiplexes them over one
+        # TLS connection when the optional h2 package is installed
+        http_version = "2" if importlib.util.find_spec("h2") else "1.1"
+        builder = (
+            Application.builder()
+            .token(config.telegram.bot_token)
+            .request(HTTPXRequest(
+                connection_pool_size=CONNECTION_POOL_SIZE,
+                pool_timeout=POOL_TIMEOUT,
+                write_timeout=UPLOAD_WRITE_TIMEOUT,
+                http_version=http_version
+            ))
+            .get_updates_request(HTTPXRequest(http_version=http_version))
+        )
+        
+        # Smooth bursts under Telegram's flood limits when the optional limiter is installed.
+        # Retries stay in _send_file (max_retries=0) so a 429 isn't retried twice
+        if importlib.util.find_spec("aiolimiter"):
+            from telegram.ext import AIORateLimiter
+            builder = builder.rate_limiter(AIORateLimiter(max_retries=0))
+        
+        self.application = builder.build()
         self.bot = self.application.bot
         
-        # Add command handlers
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("photo", self.photo_command))
-        self.application.add_handler(CommandHandler("gif", self.gif_command))
-        self.application.add_handler(CommandHandler("stats", self.stats_command))
-        self.application.add_handler(CommandHandler("status", self.status_command))
+        # Alert format is fixed for the process; pick the send method and its file kwarg once
+        if config.alert.output_format == "gif":
+            self._alert_sender = (self.bot.send_animation, "animation")
+        else:
+            self._alert_sender = (self.bot.send_video, "video")
         
         logger.info("Telegram bot initialized")
     
+    def _register_handlers(self):
+        """Register command handlers; only the long-running bot needs them, not --alert"""
+        # One handler for every command: PTB checks a single handler per update and
+        # _dispatch picks the method with a dict lookup
+        self._commands = {
+            "help": self.help_command,
+            "photo": self.photo_command,
+            "snapshot": self.snapshot_command,
+            "gif": self.gif_command,
+            "stats": self.stats_command,
+            "status": self.status_command,
+        }
+        self.application.add_handler(CommandHandler(list(self._commands), self._dispatch))
+    
+    async def _dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Route a command update to its handler method"""
+        # "/gif@TurtleCamBot 5" -> "gif"; CommandHandler has already validated it
+        command = update.message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+        await self._commands[command](update, context)
+    
+    async def _send_file(self, send_method, file_kwarg: str, file_path: Path, **kwargs):
+        """Send a file with a bot send_* method, retrying transient Telegram errors"""
+        # Read once up front, off the event loop: retries reuse the same bytes instead of
+        # reopening the file, and a multi-MB GIF read doesn't stall other updates
+        data = await asyncio.to_thread(file_path.read_bytes)
+        input_file = InputFile(data, filename=file_path.name)
+        
+        for attempt in range(config.telegram.max_retries):
+            last_attempt = attempt == config.telegram.max_retries - 1
+            try:
+                return await send_method(
+                    chat_id=self.chat_id,
+                    **{file_kwarg: input_file},
+                    **kwargs
+                )
+            
+            except RetryAfter as e:
+                if last_attempt:
+                    raise
+                logger.warning(f"Rate limited by Telegram, waiting {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            
+            except BadRequest:
+                # A NetworkError subclass, but permanent (bad caption, file too big, bad chat_id)
+                raise
+            
+            except NetworkError as e:  # Includes TimedOut
+                if last_attempt:
+                    raise
+                delay = min(config.telegram.retry_backoff ** attempt, MAX_RETRY_BACKOFF)
+                logger.warning(f"Telegram network error (attempt {attempt + 1}): {e}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+    
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show available commands"""
-        help_text = """
-🐢 **TurtleCam Commands**
-
-/photo - Capture and send a full-resolution still image
-/gif [N] - Create GIF from last N frames (default: 10)
-/stats - Show detection statistics
-/status - Show system status
-/help - Show this help message
-
-The bot will automatically send motion alerts when your turtle is active!
-        """
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
+    
+    def _capture_photo(self) -> Path:
+        """Capture a full-resolution still to a temporary JPEG"""
+        # Import here to avoid circular imports
+        from picamera2 import Picamera2
+        
+        # Capture photo
+        camera = Picamera2()
+        still_config = camera.create_still_configuration(
+            main={
+                "size": (config.camera.full_res_width, config.camera.full_res_height),
+                "format": "RGB888"
+            }
+        )
+        camera.configure(still_config)
+        camera.start()
         
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        # Capture and save
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        photo_path = Path(f"/tmp/turtle_photo_{timestamp}.jpg")
+        camera.capture_file(str(photo_path))
+        camera.stop()
+        
+        return photo_path
     
     async def photo_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Capture and send a still photo"""
         try:
             await update.message.reply_text("📸 Capturing photo...")
             
-            # Import here to avoid circular imports
-            from picamera2 import Picamera2
-            
-            # Capture photo
-            camera = Picamera2()
-            still_config = camera.create_still_configuration(
-                main={
-                    "size": (config.camera.full_res_width, config.camera.full_res_height),
-                    "format": "RGB888"
-                }
-            )
-            camera.configure(still_config)
-            camera.start()
-            
-            # Capture and save
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            photo_path = Path(f"/tmp/turtle_photo_{timestamp}.jpg")
-            camera.capture_file(str(photo_path))
-            camera.stop()
+            # Camera start + full-res capture takes seconds; keep the loop serving updates
+            photo_path = await asyncio.to_thread(self._capture_photo)
             
             # Send photo
-            with open(photo_path, 'rb') as photo_file:
-                await context.bot.send_photo(
-                    chat_id=config.telegram.chat_id,
-                    photo=photo_file,
-                    caption=f"📸 Turtle photo - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                )
+            await self._send_file(
+                context.bot.send_photo, "photo", photo_path,
+                caption=f"📸 Turtle photo - {time.strftime('%Y-%m-%d %H:%M:%S')}"
+            )
             
             # Cleanup
             photo_path.unlink(missing_ok=True)
@@ -108,6 +248,34 @@ The bot will automatically send motion alerts when your turtle is active!
             logger.error(f"Failed to capture photo: {e}")
             await update.message.reply_text(f"❌ Failed to capture photo: {str(e)}")
     
+    async def snapshot_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send a still photo with the system status as its caption (one upload for both)"""
+        try:
+            # Status sampling and the capture are both blocking; run them side by side
+            status, photo_path = await asyncio.gather(
+                self._get_system_status(),
+                asyncio.to_thread(self._capture_photo),
+                return_exceptions=True
+            )
+            if isinstance(photo_path, BaseException):
+                raise photo_path
+            
+            try:
+                # Raise a status failure only here, so the captured photo is still removed
+                if isinstance(status, BaseException):
+                    raise status
+                await self._send_file(
+                    context.bot.send_photo, "photo", photo_path,
+                    caption=STATUS_TEMPLATE.format_map({**self._status_static, **status}),
+                    parse_mode='Markdown'
+                )
+            finally:
+                photo_path.unlink(missing_ok=True)
+            
+        except Exception as e:
+            logger.error(f"Failed to send snapshot: {e}")
+            await update.message.reply_text(f"❌ Failed to send snapshot: {str(e)}")
+    
     async def gif_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Create and send GIF from recent frames"""
         try:
@@ -122,24 +290,13 @@ The bot will automatically send motion alerts when your turtle is active!
             
             await update.message.reply_text(f"🎬 Creating {config.alert.output_format.upper()} from last {frame_count} frames...")
             
-            # Build alert
-            output_path = self.alert_builder.build_from_recent_frames(frame_count)
+            # Build alert (frame decoding and encoding are CPU-bound)
+            output_path = await asyncio.to_thread(self.alert_builder.build_from_recent_frames, frame_count)
             
             if output_path and output_path.exists():
                 # Send the file
-                with open(output_path, 'rb') as alert_file:
-                    if config.alert.output_format == "gif":
-                        await context.bot.send_animation(
-                            chat_id=config.telegram.chat_id,
-                            animation=alert_file,
-                            caption=f"🐢 Recent activity ({frame_count} frames)"
-                        )
-                    else:
-                        await context.bot.send_video(
-                            chat_id=config.telegram.chat_id,
-                            video=alert_file,
-                            caption=f"🐢 Recent activity ({frame_count} frames)"
-                        )
+                caption = f"🐢 Recent activity ({frame_count} frames)"
+                await self._send_file(*self._alert_sender, output_path, caption=caption)
                 
                 # Cleanup
                 output_path.unlink(missing_ok=True)
@@ -153,7 +310,9 @@ The bot will automatically send motion alerts when your turtle is active!
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show detection statistics"""
         try:
-            stats = db.get_stats()
+            # SQLite queries can wait on the motion service's writes (busy_timeout);
+            # run them in a thread so the event loop keeps serving updates
+            stats = await asyncio.to_thread(database.db.get_stats)
             
             stats_text = f"""
 📊 **Detection Statistics**
@@ -176,42 +335,46 @@ Last detection: {stats.get('last_detection', 'None')}
             logger.error(f"Failed to get stats: {e}")
             await update.message.reply_text(f"❌ Failed to get statistics: {str(e)}")
     
+    def _collect_system_status(self) -> dict:
+        """Blocking psutil/systemctl reads for /status; runs in a worker thread"""
+        import psutil
+        import subprocess
+        
+        # System info
+        cpu_percent = psutil.cpu_percent(interval=1)
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(config.storage.base_path)
+        
+        # Check if motion detection service is running
+        try:
+            result = subprocess.run(['systemctl', 'is-active', 'turtle_motion.service'], 
+                                  capture_output=True, text=True, timeout=5)
+            motion_status = "🟢 Running" if result.returncode == 0 else "🔴 Stopped"
+        except Exception:
+            motion_status = "❓ Unknown"
+        
+        return {
+            "motion_status": motion_status,
+            "cpu_percent": cpu_percent,
+            "memory_percent": memory.percent,
+            "disk_percent": disk.percent
+        }
+    
+    async def _get_system_status(self) -> dict:
+        """System status for /status, reused for STATUS_CACHE_TTL seconds"""
+        checked_at, status = self._status_cache
+        if status is None or time.monotonic() - checked_at >= STATUS_CACHE_TTL:
+            # The 1s CPU sample and systemctl call must not block the event loop
+            status = await asyncio.to_thread(self._collect_system_status)
+            self._status_cache = (time.monotonic(), status)
+        return status
+    
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show system status"""
         try:
-            import psutil
-            import subprocess
-            
-            # System info
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage(config.storage.base_path)
+            status = await self._get_system_status()
             
-            # Check if motion detection service is running
-            try:
-                result = subprocess.run(['systemctl', 'is-active', 'turtle_motion.service'], 
-                                      capture_output=True, text=True)
-                motion_status = "🟢 Running" if result.returncode == 0 else "🔴 Stopped"
-            except:
-                motion_status = "❓ Unknown"
-            
-            status_text = f"""
-🖥️ **System Status**
-
-Motion Detection: {motion_status}
-CPU Usage: {cpu_percent:.1f}%
-Memory Usage: {memory.percent:.1f}%
-Disk Usage: {disk.percent:.1f}%
-
-📁 Storage paths:
-- Frames: {config.get_frames_path()}
-- Database: {config.get_database_path()}
-- ML Frames: {'Enabled' if config.storage.save_ml_frames else 'Disabled'}
-
-⚙️ Camera settings:
-- Preview: {config.camera.preview_width}x{config.camera.preview_height}
-- Full-res: {config.camera.full_res_width}x{config.camera.full_res_height}
-            """
+            status_text = STATUS_TEMPLATE.format_map({**self._status_static, **status})
             
             await update.message.reply_text(status_text, parse_mode='Markdown')
             
@@ -222,10 +385,16 @@ Disk Usage: {disk.percent:.1f}%
     async def send_motion_alert(self, frames_count: int = None):
         """Send motion alert to Telegram"""
         try:
-            # Rate limiting
+            # Alerts usually come from a fresh "--alert" process per motion event, so the
+            # cooldown is kept in a stamp file's mtime rather than in memory
             current_time = time.time()
-            if current_time - self.last_message_time < config.telegram.rate_limit_delay:
-                logger.debug("Rate limiting: skipping alert")
+            stamp_path = Path(config.storage.base_path) / ALERT_STAMP_FILE
+            try:
+                last_alert_time = stamp_path.stat().st_mtime
+            except FileNotFoundError:
+                last_alert_time = self.last_message_time
+            if current_time - last_alert_time < config.telegram.alert_cooldown:
+                logger.info("Motion alert suppressed: previous alert still within cooldown")
                 return
             
             # Build alert
@@ -235,66 +404,78 @@ Disk Usage: {disk.percent:.1f}%
                 logger.error("Failed to create motion alert")
                 return
             
-            # Send alert with retry logic
-            for attempt in range(config.telegram.max_retries):
-                try:
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    caption = f"🐢 Motion detected! {timestamp}"
-                    
-                    with open(output_path, 'rb') as alert_file:
-                        if config.alert.output_format == "gif":
-                            await self.bot.send_animation(
-                                chat_id=config.telegram.chat_id,
-                                animation=alert_file,
-                                caption=caption
-                            )
-                        else:
-                            await self.bot.send_video(
-                                chat_id=config.telegram.chat_id,
-                                video=alert_file,
-                                caption=caption
-                            )
-                    
-                    self.last_message_time = current_time
-                    logger.info(f"Motion alert sent successfully")
-                    break
-                    
-                except RetryAfter as e:
-                    wait_time = e.retry_after
-                    logger.warning(f"Rate limited by Telegram, waiting {wait_time}s")
-                    await asyncio.sleep(wait_time)
-                    
-                except TelegramError as e:
-                    logger.error(f"Telegram error (attempt {attempt + 1}): {e}")
-                    if attempt < config.telegram.max_retries - 1:
-                        await asyncio.sleep(config.telegram.retry_backoff ** attempt)
-                    else:
-                        logger.error("Failed to send alert after all retries")
+            # Send alert (transient errors are retried inside _send_file)
+            # Format the time already read for the cooldown check instead of building a datetime
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(current_time))
+            caption = f"🐢 Motion detected! {timestamp}"
             
-            # Cleanup
-            output_path.unlink(missing_ok=True)
+            try:
+                await self._send_file(*self._alert_sender, output_path, caption=caption)
+                
+                self.last_message_time = current_time
+                stamp_path.touch()
+                logger.info(f"Motion alert sent successfully")
+            finally:
+                # Cleanup
+                output_path.unlink(missing_ok=True)
             
         except Exception as e:
             logger.error(f"Failed to send motion alert: {e}")
     
     async def start_polling(self):
-        """Start the bot with polling"""
-        logger.info("Starting Telegram bot polling")
+        """Start the bot with polling, or with a webhook when TELEGRAM_WEBHOOK_URL is set"""
+        # Sleep until stop() or SIGINT/SIGTERM instead of waking every second to poll.
+        # Set up before anything is started, so a failure here leaves nothing to shut down
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self._stop_event.set)
+            except (NotImplementedError, RuntimeError, ValueError) as e:
+                # Not on the main thread (or no signal support): stop() still works
+                logger.debug(f"Could not install handler for {sig.name}: {e}")
+        
+        self._register_handlers()
         await self.application.initialize()
         await self.application.start()
-        await self.application.updater.start_polling()
         
-        # Keep running
         try:
-            while True:
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
-            logger.info("Received interrupt signal")
+            if config.telegram.webhook_url:
+                # Telegram pushes updates; nothing is sent while idle. The random secret is
+                # registered with setWebhook and checked on every incoming request
+                logger.info(f"Starting Telegram bot webhook on port {config.telegram.webhook_port}")
+                await self.application.updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=config.telegram.webhook_port,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{config.telegram.webhook_url.rstrip('/')}/{WEBHOOK_PATH}",
+                    secret_token=secrets.token_urlsafe(32),
+                    allowed_updates=[Update.MESSAGE],
+                    drop_pending_updates=True
+                )
+            else:
+                logger.info("Starting Telegram bot polling")
+                # Long polls mean an idle bot makes one request per poll_timeout instead of every
+                # 10s; only message updates are fetched since that is all the handlers consume
+                await self.application.updater.start_polling(
+                    timeout=config.telegram.poll_timeout,
+                    allowed_updates=[Update.MESSAGE],
+                    drop_pending_updates=True
+                )
+            
+            await self._stop_event.wait()
+            logger.info("Stopping Telegram bot")
         finally:
-            await self.application.updater.stop()
+            if self.application.updater.running:
+                await self.application.updater.stop()
             await self.application.stop()
             await self.application.shutdown()
     
+    def stop(self):
+        """Stop a running bot; safe to call from any thread"""
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+    
     def run(self):
         """Run the bot"""
         asyncio.run(self.start_polling())